@@ -1,22 +1,52 @@
-from typing import Dict, Any, List, Iterator, Tuple
+from typing import Callable, Dict, Any, List, Tuple
 import PIL.Image
 import TwitterAPI
 import argparse
+import concurrent.futures
 import configparser
 import datetime
-import glob
+import functools
+import io
 import json
 import logging
+import mmap
+import operator
 import os
 import re
 import requests
-import shutil
+import requests.adapters
+import threading
 import time
+import types
 import urllib.parse as urlparse
 
 # System Configuration
 config = configparser.RawConfigParser()
 
+# Config values and the Twitter client, set up once by load_config()
+CFG = types.SimpleNamespace()
+
+# Shared HTTP session, so connections to Scryfall are kept alive between requests
+SESSION = requests.Session()
+SESSION.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
+REQUEST_TIMEOUT = 30
+
+# Scryfall asks for 50-100ms between requests (10 req/s max)
+SCRYFALL_MAX_REQUESTS_PER_SECOND = 10
+MAX_DOWNLOAD_WORKERS = 2
+MAX_QUERY_WORKERS = 8
+
+# Matches a /regex/ term within a submitted query
+_REGEX_QUERY_RE = re.compile(r'/[^/]+/')
+
+# Matches a tweet database key, as written by write_to_json_db()
+_CONTEST_KEY_RE = re.compile(rb'\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}')
+
+# Size the merged card image is thumbnailed down to before tweeting
+TWEET_IMAGE_MAX_SIZE = (1024, 512)
+JPEG_QUALITY = 85
+
 
 def load_config(config_path: str) -> None:
     """
@@ -26,27 +56,63 @@ def load_config(config_path: str) -> None:
     # Open and read secret properties
     config.read(config_path)
 
+    CFG.LOGGING_DIR = config.get('scryfallCardGolf', 'LOGGING_DIR')
+    CFG.TEMP_CARD_DIR = config.get('scryfallCardGolf', 'TEMP_CARD_DIR')
+    CFG.SCRYFALL_RANDOM_URL = config.get('scryfallCardGolf', 'SCRYFALL_RANDOM_URL')
+    CFG.TWEET_DATABASE = config.get('scryfallCardGolf', 'TWEET_DATABASE')
+    CFG.WINNING_DIR = config.get('scryfallCardGolf', 'WINNING_DIR')
+    CFG.CONSUMER_KEY = config.get('twitter', 'CONSUMER_KEY')
+    CFG.CONSUMER_SECRET = config.get('twitter', 'CONSUMER_SECRET')
+    CFG.ACCESS_TOKEN_KEY = config.get('twitter', 'ACCESS_TOKEN_KEY')
+    CFG.ACCESS_TOKEN_SECRET = config.get('twitter', 'ACCESS_TOKEN_SECRET')
+
+    CFG.twitter_api = TwitterAPI.TwitterAPI(
+        CFG.CONSUMER_KEY,
+        CFG.CONSUMER_SECRET,
+        CFG.ACCESS_TOKEN_KEY,
+        CFG.ACCESS_TOKEN_SECRET,
+    )
+
     # Logging configuration
     logging.basicConfig(
         level=logging.INFO,
         format='[%(levelname)s] %(asctime)s: %(message)s',
         handlers=[
             logging.StreamHandler(),
-            logging.FileHandler(
-                str(config.get('scryfallCardGolf', 'LOGGING_DIR')) + 'card_golf_' +
-                str(time.strftime('%Y-%m-%d_%H:%M:%S')) + '.log')
+            logging.FileHandler(CFG.LOGGING_DIR + 'card_golf_' + str(time.strftime('%Y-%m-%d_%H:%M:%S')) + '.log')
         ])
 
 
-def extract_query_length(json_dict: Dict[str, str]) -> int:
+def rate_limited(max_per_second: float) -> Callable[[Callable[..., Any]], Callable[..., Any]]:
     """
-    Query sort key to get length
-    :param json_dict:
-    :return: Length of object
+    Decorator to keep a function from being called more than
+    max_per_second times per second, shared across all threads
+    :param max_per_second: Most calls allowed per second
+    :return: Decorator for the function to limit
     """
-    return int(json_dict.get('length', 0))
+    min_interval: float = 1.0 / max_per_second
+    lock = threading.Lock()
+    next_call_time: float = 0.0
+
+    def decorator(func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            nonlocal next_call_time
+            with lock:
+                now: float = time.monotonic()
+                wait_time: float = next_call_time - now
+                next_call_time = max(now, next_call_time) + min_interval
 
+            if wait_time > 0:
+                time.sleep(wait_time)
+            return func(*args, **kwargs)
 
+        return wrapper
+
+    return decorator
+
+
+@rate_limited(SCRYFALL_MAX_REQUESTS_PER_SECOND)
 def download_contents(url: str, download_type: str = 'json') -> Any:
     """
     Download contents from a URL
@@ -56,20 +122,25 @@ def download_contents(url: str, download_type: str = 'json') -> Any:
     """
     request_response: Any = {}
     if download_type == 'json':
-        request_response = requests.get(url=url).json()
+        request_response = SESSION.get(url=url, timeout=REQUEST_TIMEOUT).json()
     elif download_type == 'image':
-        request_response = requests.get(url=url, stream=True)
+        request_response = SESSION.get(url=url, timeout=REQUEST_TIMEOUT).content
 
-    logging.info('Downloaded URL {}'.format(url))
+    logging.info('Downloaded URL %s', url)
     return request_response
 
 
 def delete_temp_cards() -> None:
     """
-    Delete the PNG images in the image folder
+    Delete the card images in the image folder
+    (including PNGs left behind by older versions)
     """
-    for card in glob.glob(os.path.join(config.get('scryfallCardGolf', 'TEMP_CARD_DIR'), '*.png')):
-        logging.info('Deleting file {}'.format(card))
+    cards_to_delete: List[str] = [
+        entry.path for entry in os.scandir(CFG.TEMP_CARD_DIR)
+        if entry.is_file() and entry.name.endswith(('.jpg', '.png'))
+    ]
+    for card in cards_to_delete:
+        logging.info('Deleting file %s', card)
         os.remove(card)
 
 
@@ -79,22 +150,12 @@ def download_random_cards(number_of_cards: int) -> List[Dict[str, Any]]:
     :param number_of_cards: How many cards to play with
     :return: List of card objects requested
     """
-    return [download_contents(config.get('scryfallCardGolf', 'SCRYFALL_RANDOM_URL')) for _ in range(number_of_cards)]
+    def download_random_card(_: int) -> Dict[str, Any]:
+        card: Dict[str, Any] = download_contents(CFG.SCRYFALL_RANDOM_URL)
+        return card
 
-
-def resize_image(url_to_open: str) -> None:
-    """
-    Some of the image combinations created are too large for Twitter.
-    This method will resize the image to allow for proper tweet size.
-    This will resize in-place.
-    :param url_to_open: Local URL to get image from
-    """
-    try:
-        im = PIL.Image.open(url_to_open)
-        im.thumbnail((1024, 512), PIL.Image.ANTIALIAS)
-        im.save(url_to_open, 'PNG')
-    except IOError:
-        logging.exception('Cannot create thumbnail for {}'.format(url_to_open))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_DOWNLOAD_WORKERS) as executor:
+        return list(executor.map(download_random_card, range(number_of_cards)))
 
 
 def send_tweet(message_to_tweet: str, url_to_media: str) -> int:
@@ -105,23 +166,16 @@ def send_tweet(message_to_tweet: str, url_to_media: str) -> int:
     :return: Tweet ID (-1 if it failed)
     :raises Exception: Tweet failed to send for some reason
     """
-    twitter_api = TwitterAPI.TwitterAPI(
-        config.get('twitter', 'CONSUMER_KEY'),
-        config.get('twitter', 'CONSUMER_SECRET'),
-        config.get('twitter', 'ACCESS_TOKEN_KEY'),
-        config.get('twitter', 'ACCESS_TOKEN_SECRET'),
-    )
-
-    logging.info('Tweet to send: {}'.format(message_to_tweet))
+    logging.info('Tweet to send: %s', message_to_tweet)
     try:
         if url_to_media is not None:
-            resize_image(url_to_media)
             photo = open(url_to_media, 'rb')
-            status = twitter_api.request('statuses/update_with_media', {'status': message_to_tweet}, {'media[]': photo})
-            logging.info('Twitter Status Code: {}'.format(status.status_code))
+            status = CFG.twitter_api.request('statuses/update_with_media', {'status': message_to_tweet},
+                                             {'media[]': photo})
+            logging.info('Twitter Status Code: %s', status.status_code)
 
             response = TwitterAPI.TwitterResponse(status, False).json()
-            logging.info('Twitter Response Parsed: {}'.format(response))
+            logging.info('Twitter Response Parsed: %s', response)
             return int(response['id_str'])
         raise Exception("No image attached to tweet")
     except UnicodeDecodeError:
@@ -129,55 +183,65 @@ def send_tweet(message_to_tweet: str, url_to_media: str) -> int:
         raise Exception("Tweet failed to send")
 
 
-def download_and_save_card_images(cards: List[Dict[str, Any]]) -> None:
+def fetch_and_decode(url: str) -> Any:
     """
-    Download and (temporarily) save card images for tweet processing
-    :param cards: Cards to download and store
+    Download a card image straight into memory and decode it
+    :param url: URL of the card image
+    :return: Decoded image
     """
-    for card in cards:
-        card_image_url: str = card['image_uris']['png']
-        request_image = download_contents(card_image_url, 'image')
-        with open(
-                os.path.join(
-                    config.get('scryfallCardGolf', 'TEMP_CARD_DIR'), '{}.png'.format(card['name'].replace('//', '_'))),
-                'wb') as out_file:
-            shutil.copyfileobj(request_image.raw, out_file)
-        logging.info('Saving image of card {}'.format(card['name']))
+    image_contents: bytes = download_contents(url, 'image')
+    im = PIL.Image.open(io.BytesIO(image_contents))
+    im.load()
+    return im
 
 
-def merge_card_images(cards: List[Dict[str, Any]]) -> str:
+def merge_card_images(cards: List[Dict[str, Any]], images: List[Any]) -> str:
     """
-    Taken from SO, but this method will merge all images in the
-    images folder into one image. All prior images will be
-    side-by-side
+    Taken from SO, but this method will merge all card images
+    into one image. All prior images will be side-by-side
     :param cards: Cards to merge into one image
+    :param images: Decoded images of the cards, in the same order
     :return: Resting URL of merged image
     """
-    cards_to_merge: List[str] = glob.glob(os.path.join(config.get('scryfallCardGolf', 'TEMP_CARD_DIR'), '*.png'))
+    sizes: List[Tuple[int, int]] = [im.size for im in images]
 
-    images: Iterator[Any] = map(PIL.Image.open, cards_to_merge)
-    widths, heights = zip(*(i.size for i in images))
-
-    total_width = sum(widths)
-    max_height = max(heights)
+    total_width = sum(width for width, _ in sizes)
+    max_height = max(height for _, height in sizes)
 
     new_im = PIL.Image.new('RGB', (total_width, max_height))
 
-    images = map(PIL.Image.open, cards_to_merge)
     x_offset = 0
     for im in images:
         new_im.paste(im, (x_offset, 0))
         x_offset += im.size[0]
+        im.close()
 
-    combined_name: str = '{}-{}.png'.format(cards[0]['name'].replace('/', '_'), cards[1]['name'].replace('/', '_'))
-    save_url: str = os.path.join(config.get('scryfallCardGolf', 'TEMP_CARD_DIR'), combined_name)
+    combined_name: str = '{}-{}.jpg'.format(cards[0]['name'].replace('/', '_'), cards[1]['name'].replace('/', '_'))
+    save_url: str = os.path.join(CFG.TEMP_CARD_DIR, combined_name)
 
-    new_im.save(save_url)
-    logging.info('Saved merged image to {}'.format(save_url))
+    # Some of the image combinations created are too large for Twitter
+    new_im.thumbnail(TWEET_IMAGE_MAX_SIZE, PIL.Image.LANCZOS)
+    new_im.save(save_url, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    logging.info('Saved merged image to %s', save_url)
 
     return save_url
 
 
+def write_file_atomically(file_name: str, contents: str) -> None:
+    """
+    Write contents to a temporary file and swap it into place,
+    so an interrupted write can't leave a corrupted file behind
+    :param file_name: File to write
+    :param contents: New contents of the file
+    """
+    temp_file_name: str = '{}.tmp'.format(file_name)
+    with open(temp_file_name, mode='w') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file_name, file_name)
+
+
 def write_to_json_db(file_name: str, entry: Any, database: bool = False) -> None:
     """
     Write out a dictionary into the json database
@@ -192,12 +256,11 @@ def write_to_json_db(file_name: str, entry: Any, database: bool = False) -> None
                 feeds = json.load(json_feed)
         feeds[time.strftime('%Y-%m-%d_%H:%M:%S')] = entry
     else:
-        feeds['standard'] = sorted(entry[0], key=extract_query_length, reverse=False)
-        feeds['regex'] = sorted(entry[1], key=extract_query_length, reverse=False)
+        feeds['standard'] = sorted(entry[0], key=operator.itemgetter('length'))
+        feeds['regex'] = sorted(entry[1], key=operator.itemgetter('length'))
 
-    with open(file_name, mode='w') as f:
-        # For some reason, backslashes appear as \\ instead of \. This fixes it :(
-        f.write(json.dumps(feeds, indent=4, sort_keys=True))
+    # For some reason, backslashes appear as \\ instead of \. This fixes it :(
+    write_file_atomically(file_name, json.dumps(feeds, indent=4, sort_keys=True))
 
 
 def load_json_db(file_name: str) -> Any:
@@ -213,6 +276,31 @@ def load_json_db(file_name: str) -> Any:
         return json.load(json_feed)
 
 
+def load_latest_key(file_name: str) -> str:
+    """
+    Get the newest contest key in the database, scanning backwards
+    for the last key instead of parsing the whole database
+    :param file_name: Location of database
+    :return: Newest contest key ('' if database is empty)
+    """
+    if not os.path.isfile(file_name) or os.path.getsize(file_name) == 0:
+        return ''
+
+    # The database is written with sorted keys and an indent of 4,
+    # so the last line indented once starts with the newest key
+    key_prefix: bytes = b'\n    "'
+    with open(file_name, 'rb') as json_feed, mmap.mmap(json_feed.fileno(), 0, access=mmap.ACCESS_READ) as json_map:
+        key_start: int = json_map.rfind(key_prefix)
+        if key_start != -1:
+            key_start += len(key_prefix)
+            candidate_key: bytes = json_map[key_start:json_map.find(b'"', key_start)]
+            if _CONTEST_KEY_RE.fullmatch(candidate_key):
+                return candidate_key.decode()
+
+    # Not laid out the way we write it, so parse the whole database
+    return max(load_json_db(file_name).keys(), default='')
+
+
 def is_active_contest_already(force_new_contest: bool) -> bool:
     """
     Determine if there is a current competition live.
@@ -220,10 +308,8 @@ def is_active_contest_already(force_new_contest: bool) -> bool:
     :return: Active contest status
     """
     # See if a current contest is active
-    json_db: Dict[str, Any] = load_json_db(config.get('scryfallCardGolf', 'TWEET_DATABASE'))
-    try:
-        max_key: str = max(json_db.keys())
-    except ValueError:
+    max_key: str = load_latest_key(CFG.TWEET_DATABASE)
+    if not max_key:
         logging.warning("Database was empty, continuing")
         return False
 
@@ -231,112 +317,116 @@ def is_active_contest_already(force_new_contest: bool) -> bool:
     current_contest_end_date: datetime.datetime = current_contest_start_date + datetime.timedelta(days=1)
 
     if not force_new_contest and current_contest_end_date > datetime.datetime.now():
-        logging.warning('Current contest from {} still active'.format(max_key))
+        logging.warning('Current contest from %s still active', max_key)
         return True
 
-    write_results(get_results())
+    write_results(get_results(max_key), max_key)
     return False
 
 
-def test_query(user_name: str, scryfall_url: str) -> str:
+def test_query(user_name: str, scryfall_url: str, valid_cards: List[str]) -> str:
     """
     Load up the Scryfall URL tweeted by the user and see if it
     matches the competition requirements (i.e. is it exclusively
     the two cards we are looking for)
     :param user_name: Twitter username
     :param scryfall_url: Scryfall URL they tweeted
+    :param valid_cards: Names of the cards in the current contest
     :return: Winning query ('' if failed)
     """
     try:
+        # parse_qs already percent-decodes, so this is the query exactly as the user typed it
         query: str = urlparse.parse_qs(urlparse.urlparse(scryfall_url).query)['q'][0]
 
         scryfall_api_url = 'https://api.scryfall.com/cards/search?q={}'.format(urlparse.quote_plus(query))
         response: Dict[str, Any] = download_contents(scryfall_api_url)
 
         if response['total_cards'] != 2:
-            logging.info('{} result has wrong number of cards: {}'.format(user_name, response['total_cards']))
+            logging.info('%s result has wrong number of cards: %s', user_name, response['total_cards'])
 
-        json_db: Dict[str, Any] = load_json_db(config.get('scryfallCardGolf', 'TWEET_DATABASE'))
-        max_key: str = max(json_db.keys())
-        valid_cards: List[str] = [json_db[max_key]['cards'][0]['name'], json_db[max_key]['cards'][1]['name']]
         for card in response['data']:
             if card['name'] not in valid_cards:
-                logging.info('{} result has wrong card: {}'.format(user_name, card['name']))
+                logging.info('%s result has wrong card: %s', user_name, card['name'])
                 return ''
 
         if ' or ' in query.lower():
-            logging.info("{} was correct, but they may have used 'OR': {}".format(user_name, query))
-            return urlparse.unquote(query)
+            logging.info("%s was correct, but they may have used 'OR': %s", user_name, query)
+            return query
 
         # Correct response!
-        logging.info('{} was correct! [ {} ] ({})'.format(user_name, query, len(query)))
-        return urlparse.unquote(query)
+        logging.info('%s was correct! [ %s ] (%s)', user_name, query, len(query))
+        return query
     except KeyError:
-        logging.info('{} submitted a bad Scryfall URL: {}'.format(user_name, scryfall_url))
+        logging.info('%s submitted a bad Scryfall URL: %s', user_name, scryfall_url)
+        return ''
+    except (requests.RequestException, ValueError):
+        logging.exception('Could not check %s submission: %s', user_name, scryfall_url)
         return ''
 
 
-def get_results() -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
+def get_results(max_key: str) -> Tuple[List[Dict[str, str]], List[Dict[str, str]]]:
     """
     Get the results from the competition and print it out
+    :param max_key: Database key of the contest to get results for
     :return: Winner's name and their query
     """
-    twitter_api = TwitterAPI.TwitterAPI(
-        config.get('twitter', 'CONSUMER_KEY'),
-        config.get('twitter', 'CONSUMER_SECRET'),
-        config.get('twitter', 'ACCESS_TOKEN_KEY'),
-        config.get('twitter', 'ACCESS_TOKEN_SECRET'),
-    )
-
     valid_normal_entries: List[Dict[str, Any]] = []
     valid_regex_entries: List[Dict[str, Any]] = []
 
     logging.info('GET RESULTS')
 
-    json_db: Dict[str, Any] = load_json_db(config.get('scryfallCardGolf', 'TWEET_DATABASE'))
-    max_key: str = max(json_db.keys())
+    json_db: Dict[str, Any] = load_json_db(CFG.TWEET_DATABASE)
+    valid_cards: List[str] = [card['name'] for card in json_db[max_key]['cards']]
 
-    r = TwitterAPI.TwitterPager(twitter_api, 'statuses/mentions_timeline', {
+    r = TwitterAPI.TwitterPager(CFG.twitter_api, 'statuses/mentions_timeline', {
         'count': 200,
         'since_id': json_db[max_key]['tweet_id']
     })
 
+    submissions: List[Tuple[str, str]] = []
     for item in r.get_iterator():
         if 'text' not in item:
-            logging.warning('SUSPEND, RATE LIMIT EXCEEDED: ' + item['message'])
+            logging.warning('SUSPEND, RATE LIMIT EXCEEDED: %s', item['message'])
             break
 
-        logging.info('[TWEET] ' + item['user']['screen_name'] + ': ' + item['text'])
+        logging.info('[TWEET] %s: %s', item['user']['screen_name'], item['text'])
         for url in item['entities']['urls']:
             test_url = url['expanded_url']
             if 'scryfall.com' not in test_url:
                 continue
 
-            logging.info('{} submitted solution: {}'.format(item['user']['screen_name'], test_url))
-            test_query_results = test_query(item['user']['screen_name'], test_url)
-            if test_query_results:
-                user_json_entry: Dict[str, Any] = {
-                    'name': item['user']['screen_name'],
-                    'length': len(test_query_results),
-                    'query': test_query_results
-                }
+            logging.info('%s submitted solution: %s', item['user']['screen_name'], test_url)
+            submissions.append((item['user']['screen_name'], test_url))
+
+    def test_submission(submission: Tuple[str, str]) -> str:
+        return test_query(submission[0], submission[1], valid_cards)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_QUERY_WORKERS) as executor:
+        all_query_results: List[str] = list(executor.map(test_submission, submissions))
+
+    for (user_name, _), test_query_results in zip(submissions, all_query_results):
+        if test_query_results:
+            user_json_entry: Dict[str, Any] = {
+                'name': user_name,
+                'length': len(test_query_results),
+                'query': test_query_results
+            }
 
-                if re.search(r'/.+/', test_query_results):
-                    valid_regex_entries.append(user_json_entry)
-                else:
-                    valid_normal_entries.append(user_json_entry)
+            if _REGEX_QUERY_RE.search(test_query_results):
+                valid_regex_entries.append(user_json_entry)
+            else:
+                valid_normal_entries.append(user_json_entry)
 
     return valid_normal_entries, valid_regex_entries
 
 
-def write_results(results: Tuple[List[Dict[str, str]], List[Dict[str, str]]]) -> None:
+def write_results(results: Tuple[List[Dict[str, str]], List[Dict[str, str]]], file_key: str) -> None:
     """
     Take a list of results and put it to the winners file for that contest
     :param results: List of winners
+    :param file_key: Database key of the contest the results are for
     """
-    file_key: str = max(load_json_db(config.get('scryfallCardGolf', 'TWEET_DATABASE')).keys())
-    write_to_json_db(
-        os.path.join(config.get('scryfallCardGolf', 'WINNING_DIR'), 'winners_{}.json'.format(file_key)), results)
+    write_to_json_db(os.path.join(CFG.WINNING_DIR, 'winners_{}.json'.format(file_key)), results)
 
 
 def start_game(force_new: bool = False) -> None:
@@ -357,13 +447,13 @@ def start_game(force_new: bool = False) -> None:
     card2 = '{}: {}'.format(cards[1]['name'], cards[1]['scryfall_uri'].replace('api', 'card_golf'))
 
     for card in cards:
-        logging.info('Card to merge: {}'.format(card['name']))
+        logging.info('Card to merge: %s', card['name'])
 
-    # Save the images
-    download_and_save_card_images(cards)
+    # Download the images
+    card_images: List[Any] = [fetch_and_decode(card['image_uris']['normal']) for card in cards]
 
     # Merge the images
-    tweet_image_url: str = merge_card_images(cards)
+    tweet_image_url: str = merge_card_images(cards, card_images)
 
     message = ("Can you get these cards to show up in a Scryfall search without using 'or'?\n"
                "• {}\n"
@@ -384,7 +474,7 @@ def start_game(force_new: bool = False) -> None:
         }],
     }
 
-    write_to_json_db(config.get('scryfallCardGolf', 'TWEET_DATABASE'), json_entry, True)
+    write_to_json_db(CFG.TWEET_DATABASE, json_entry, True)
 
 
 def main() -> None:
@@ -397,7 +487,8 @@ def main() -> None:
     load_config(args.config)
 
     if args.results:
-        write_results(get_results())
+        max_key: str = load_latest_key(CFG.TWEET_DATABASE)
+        write_results(get_results(max_key), max_key)
         return
 
     start_game(args.force_new)
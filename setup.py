@@ -27,4 +27,10 @@ setuptools.setup(
         'pillow',
         'TwitterAPI',
     ],
+    extras_require={
+        'dev': [
+            'pytest',
+            'pytest-cov',
+        ],
+    },
 )
\ No newline at end of file
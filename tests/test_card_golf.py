@@ -0,0 +1,83 @@
+import json
+import pathlib
+import threading
+import time
+from typing import List
+
+from ScryfallCardGolf import card_golf
+
+CONTESTS = {
+    '2018-08-14_23:30:58': {
+        'tweet_id': 1,
+        'cards': [{
+            'name': 'Card A',
+            'url': 'https://scryfall.com/card/a'
+        }]
+    },
+    '2018-09-01_10:27:23': {
+        'tweet_id': 2,
+        'cards': [{
+            'name': 'Card B',
+            'url': 'https://scryfall.com/card/b'
+        }]
+    },
+}
+
+
+def test_load_latest_key_indented(tmp_path: pathlib.Path) -> None:
+    db = tmp_path / 'tweet_database.json'
+    db.write_text(json.dumps(CONTESTS, indent=4, sort_keys=True))
+    assert card_golf.load_latest_key(str(db)) == '2018-09-01_10:27:23'
+
+
+def test_load_latest_key_compact(tmp_path: pathlib.Path) -> None:
+    db = tmp_path / 'tweet_database.json'
+    db.write_text(json.dumps(CONTESTS))
+    assert card_golf.load_latest_key(str(db)) == '2018-09-01_10:27:23'
+
+
+def test_load_latest_key_indent_2(tmp_path: pathlib.Path) -> None:
+    db = tmp_path / 'tweet_database.json'
+    db.write_text(json.dumps(CONTESTS, indent=2, sort_keys=True))
+    assert card_golf.load_latest_key(str(db)) == '2018-09-01_10:27:23'
+
+
+def test_load_latest_key_empty_database(tmp_path: pathlib.Path) -> None:
+    db = tmp_path / 'tweet_database.json'
+    db.write_text('{}')
+    assert card_golf.load_latest_key(str(db)) == ''
+
+
+def test_load_latest_key_missing_database(tmp_path: pathlib.Path) -> None:
+    assert card_golf.load_latest_key(str(tmp_path / 'tweet_database.json')) == ''
+
+
+def test_load_latest_key_after_write(tmp_path: pathlib.Path) -> None:
+    db = tmp_path / 'tweet_database.json'
+    db.write_text(json.dumps(CONTESTS, indent=4, sort_keys=True))
+    card_golf.write_to_json_db(str(db), {'tweet_id': 3, 'cards': []}, True)
+    assert card_golf.load_latest_key(str(db)) == max(card_golf.load_json_db(str(db)).keys())
+    assert card_golf.load_latest_key(str(db)) not in CONTESTS
+
+
+def test_rate_limited_spaces_calls_across_threads() -> None:
+    max_per_second = 20
+    call_times: List[float] = []
+    call_times_lock = threading.Lock()
+
+    @card_golf.rate_limited(max_per_second)
+    def record_call() -> None:
+        with call_times_lock:
+            call_times.append(time.monotonic())
+
+    threads = [threading.Thread(target=record_call) for _ in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    call_times.sort()
+    gaps = [later - earlier for earlier, later in zip(call_times, call_times[1:])]
+    assert len(call_times) == 10
+    # Small tolerance for time.sleep() waking up a hair early
+    assert min(gaps) >= 1 / max_per_second - 0.005